@@ -15,6 +15,9 @@
    select osml10n_cc_translit('東京');
     ---> "dōng jīng"
    
+   if host starts with a slash it is the path of a UNIX domain socket
+   select osml10n_cc_translit('東京','jp','/run/osml10n/osml10n.sock');
+   
 */
 
 
@@ -24,8 +27,12 @@ CREATE or REPLACE FUNCTION osml10n_cc_translit(name text, country text DEFAULT '
   import struct
 
   try:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((host, port))
+    if host.startswith('/'):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      sock.connect(host)
+    else:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.connect((host, port))
     data = ('CC/X/' + country + '/' + name).encode('utf-8');
 
     length = len(data)
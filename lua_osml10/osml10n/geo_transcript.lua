@@ -1,18 +1,36 @@
 local osml10n = {}
 
+-- if server_host starts with a slash it is the path of a UNIX domain socket
 local server_host = '127.0.0.1'
 local server_port = 8033
 
 local socket = require('socket')
-local sock = socket.connect(server_host, server_port)
+local sock
 
-if not sock then
+if string.sub(server_host, 1, 1) == '/' then
+  local unix = require('socket.unix')
+  -- newer luasocket versions provide unix.stream, older ones unix()
+  if type(unix) == 'table' and unix.stream then
+    sock = unix.stream()
+  else
+    sock = unix()
+  end
+  if not sock:connect(server_host) then
+    sock = nil
+  end
+  if not sock then
+    error("Can not connect to server " .. server_host ..
+          ". Is geo-transcript-srv.py running?")
+  end
+else
+  sock = socket.connect(server_host, server_port)
+  if not sock then
     error("Can not connect to server " .. server_host .. ":" .. server_port ..
           ". Is geo-transcript-srv.py running?")
+  end
+  sock:setoption('tcp-nodelay', true)
 end
 
-sock:setoption('tcp-nodelay', true)
-
 function osml10n.geo_transcript(id,name,bbox)
   local lon,lat,reqbody
   local bx = {}
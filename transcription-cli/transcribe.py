@@ -1,8 +1,10 @@
 #!/usr/bin/python3
 #
-#  Usage: transcribe.py REQUEST
+#  Usage: transcribe.py REQUEST [HOST]
 #
 #  REQUEST must be in format "CC/id/cc/words" or "XY/id/lon/lat/words".
+#  HOST defaults to localhost, if it starts with a slash it is the path
+#  of a UNIX domain socket.
 #
 
 import socket
@@ -10,17 +12,25 @@ import struct
 import sys
 
 def die_usage():
-    sys.stdout.write("usage: %s CC/id/cc/words|XY/id/lon/lat/words\n" % sys.argv[0])
+    sys.stdout.write("usage: %s CC/id/cc/words|XY/id/lon/lat/words [host|socket]\n" % sys.argv[0])
     sys.exit(1)
 
-if (len(sys.argv) != 2):
+if (len(sys.argv) < 2) or (len(sys.argv) > 3):
     die_usage()
 
 arglen = len(sys.argv[1].split('/'))
 if (arglen < 4) or (arglen > 5):
     die_usage()
 
-sock = socket.create_connection(('localhost', 8033))
+host = 'localhost'
+if (len(sys.argv) == 3):
+    host = sys.argv[2]
+
+if host.startswith('/'):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(host)
+else:
+    sock = socket.create_connection((host, 8033))
 
 data = sys.argv[1].encode('utf-8')
 length = len(data)
@@ -2,24 +2,32 @@
 
 import argparse
 import asyncio
+import collections
 import contextlib
+import functools
 import json
 import os
 import pathlib
+import re
 import shapely.geometry
 import shapely.prepared
-import struct
+import signal
+import socket
+import sqlite3
+import stat
 import sys
 import pkg_resources
 from importlib.metadata import version
 
 # as imports are very slow parse arguments first
 parser = argparse.ArgumentParser(description='Server for transcription of names based on geolocation')
-parser.add_argument("-b", "--bindaddr", type=str, default="localhost", help="local bind address")
+parser.add_argument("-b", "--bindaddr", type=str, default="localhost", help="local bind address or absolute path of a UNIX domain socket")
 parser.add_argument("-p", "--port", default=8033, help="port to listen at")
 parser.add_argument('-s', '--sdnotify',  action='store_true', help='Signal systemd when daemon is ready to serve')
 parser.add_argument("-v", "--verbose", action='store_true', help="print verbose output")
 parser.add_argument('-g', '--geomdir', help='Directory with geometries')
+parser.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes, 0 for one per CPU core")
+parser.add_argument('-c', '--cachefile', help='SQLite file for a persistent transcription cache')
 
 args = parser.parse_args()
 
@@ -40,7 +48,6 @@ sys.stdout.flush()
 vout("\n")
 
 import icu
-import unicodedata
 
 try:
   # Kanji in JP
@@ -69,106 +76,272 @@ except Exception as ex:
   sys.stderr.write("Error message was:\n%s\n" % ex)
   sys.exit(1)
 
+# Codepoint based classification of characters as needed for segmentation
+# of Thai and Chinese strings. This is much cheaper than looking at the
+# prefix of unicodedata.name() while giving the same result for the
+# scripts we care about.
+OTHER = 0
+THAI = 1
+CJK = 2
+
+THAI_RANGES = ((0x0E00, 0x0E7F),)
+CJK_RANGES = ((0x2E80, 0x2EFF), (0x31C0, 0x31EF), (0x3400, 0x4DBF),
+              (0x4E00, 0x9FFF), (0xF900, 0xFAFF), (0x20000, 0x3FFFF))
+
+def alphabet(c):
+  cp = ord(c)
+  for (first, last) in THAI_RANGES:
+    if first <= cp <= last:
+      return THAI
+  for (first, last) in CJK_RANGES:
+    if first <= cp <= last:
+      return CJK
+  return OTHER
+
+# The same ranges compiled into a regular expression, so splitting a string
+# is done in a single scan by the regex engine rather than a Python loop.
+def _charclass(ranges):
+  return ''.join('%s-%s' % (chr(first), chr(last)) for (first, last) in ranges)
+
+_thai_class = _charclass(THAI_RANGES)
+_cjk_class = _charclass(CJK_RANGES)
+_split_re = re.compile('[%s]+|[%s]+|[^%s%s]+' % (_thai_class, _cjk_class, _thai_class, _cjk_class))
+
 def split_by_alphabet(str):
-    strlist=[]
-    target=''
-    oldalphabet=unicodedata.name(str[0]).split(' ')[0]
-    target=str[0]
-    for c in str[1:]:
-      alphabet=unicodedata.name(c).split(' ')[0]
-      if (alphabet==oldalphabet):
-        target=target+c
-      else:
-        strlist.append(target)
-        target=c
-      oldalphabet=alphabet
-    strlist.append(target)
-    return(strlist)
+  return _split_re.findall(str)
 
 def thai_transcript(inpstr):
   stlist=split_by_alphabet(inpstr)
 
-  latin = ''
+  latin = []
   for st in stlist:
-    if (unicodedata.name(st[0]).split(' ')[0] == 'THAI'):
+    if (alphabet(st[0]) == THAI):
       transcript=''
       try:
         transcript=tltk.nlp.th2roman(st).rstrip('<s/>').rstrip()
       except:
         sys.stderr.write("tltk error transcribing >%s<\n" % st)
         return(None)
-      latin=latin+transcript
+      latin.append(transcript)
     else:
-      latin=latin+st
-  return(latin)
+      latin.append(st)
+  return(''.join(latin))
 
 def cantonese_transcript(inpstr):
   stlist=split_by_alphabet(inpstr)
 
-  latin = ''
+  latin = []
   for st in stlist:
-    if (unicodedata.name(st[0]).split(' ')[0] == 'CJK'):
+    if (alphabet(st[0]) == CJK):
       transcript=''
       try:
         transcript=pinyin_jyutping_sentence.jyutping(st, spaces=True)
       except:
         sys.stderr.write("pinyin_jyutping_sentence error transcribing >%s<\n" % st)
         return(None)
-      latin=latin+transcript
+      latin.append(transcript)
     else:
-      latin=latin+st
-  return(latin)
-
-# helper function "contains_thai"
-# checks if string contains Thai language characters
-# 0x0400-0x04FF in unicode table
-def contains_thai(text):
-  for c in text:
-    if (ord(c) > 0x0E00) and (ord(c) < 0x0E7F):
-      return True
-  return False
-
-# helper function "contains_cjk"
-# checks if string contains CJK characters
-# 0x4e00-0x9FFF in unicode table
-def contains_cjk(text):
-  for c in text:
-    if (ord(c) > 0x4e00) and (ord(c) < 0x9FFF):
-      return True
-  return False
+      latin.append(st)
+  return(''.join(latin))
+
+# CJK characters 0x4e00-0x9FFF in unicode table
+_cjk_re = re.compile('[\u4E00-\u9FFF]')
+
+# helper function "detect_script"
+# returns 'cjk' if string contains CJK characters, 'th' if it contains Thai
+# language characters (0x0E00-0x0E7F in unicode table) but no CJK characters
+# and None otherwise using a single scan
+_script_re = re.compile('([\u0E00-\u0E7F])|([\u4E00-\u9FFF])')
+
+def detect_script(text):
+  m = _script_re.search(text)
+  if m is None:
+    return None
+  if m.lastindex == 2:
+    return 'cjk'
+  # CJK takes precedence, so continue scanning after the Thai character
+  if _cjk_re.search(text, m.end()) is not None:
+    return 'cjk'
+  return 'th'
+
+# Simple in-memory LRU cache. Unlike functools.lru_cache this allows to
+# decide which results get cached, as errors must not be.
+class LRUCache:
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.data = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    try:
+      value = self.data[key]
+    except KeyError:
+      self.misses += 1
+      return None
+    self.data.move_to_end(key)
+    self.hits += 1
+    return value
+
+  def set(self, key, value):
+    self.data[key] = value
+    self.data.move_to_end(key)
+    if len(self.data) > self.maxsize:
+      self.data.popitem(last=False)
+
+  def cache_info(self):
+    return f'hits={self.hits}, misses={self.misses}, maxsize={self.maxsize}, currsize={len(self.data)}'
+
+# Persistent transcription cache stored in an SQLite database, so restarts
+# of the daemon do not lose the results of earlier transcriptions.
+# The database is opened on first use and may be shared between processes.
+# Entries are dropped if the versions of the transcription libraries changed.
+# As the cache is only an optimization any error disables it, while a locked
+# database is treated as a cache miss to not block the event loop.
+class TranscriptCache:
+  def __init__(self, filename, versions):
+    self.filename = filename
+    self.versions = versions
+    self.db = None
+    self.disabled = False
+
+  def open(self):
+    db = sqlite3.connect(self.filename, isolation_level=None, timeout=0.05)
+    try:
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('PRAGMA synchronous=NORMAL')
+      db.execute('CREATE TABLE IF NOT EXISTS transcript (country TEXT, name TEXT, latin TEXT, PRIMARY KEY (country, name))')
+      db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+      row = db.execute("SELECT value FROM meta WHERE key='versions'").fetchone()
+      if row is None or row[0] != self.versions:
+        vout(f"Clearing transcription cache {self.filename} (created using {row[0] if row else 'unknown versions'})\n")
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('DELETE FROM transcript')
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('versions',?)", (self.versions,))
+        db.execute('COMMIT')
+    except BaseException:
+      db.close()
+      raise
+    self.db = db
+
+  def error(self, err):
+    if isinstance(err, sqlite3.OperationalError) and 'locked' in str(err):
+      vout(f"transcription cache {self.filename} is locked, ignoring\n")
+      return
+    sys.stderr.write(f"Disabling transcription cache {self.filename}: {err}\n")
+    self.disabled = True
+    if self.db is not None:
+      with contextlib.suppress(sqlite3.Error):
+        self.db.close()
+      self.db = None
+
+  def get(self, country, name):
+    if self.disabled:
+      return None
+    try:
+      if self.db is None:
+        self.open()
+      row = self.db.execute('SELECT latin FROM transcript WHERE country=? AND name=?', (country, name)).fetchone()
+    except sqlite3.Error as err:
+      self.error(err)
+      return None
+    if row is None:
+      return None
+    return row[0]
+
+  def set(self, country, name, latin):
+    if self.disabled:
+      return
+    try:
+      if self.db is None:
+        self.open()
+      self.db.execute('INSERT OR REPLACE INTO transcript VALUES (?,?,?)', (country, name, latin))
+    except sqlite3.Error as err:
+      self.error(err)
 
 class transcriptor:
-  def __init__(self):
+  def __init__(self, cachefile=None, versions=''):
 
-    # ICU transliteration instance
-    self.icutr = icu.Transliterator.createInstance('Any-Latin').transliterate
+    # ICU transliteration instance, output is normalized to NFC by ICU itself
+    self.icutr = icu.Transliterator.createInstance('Any-Latin; NFC').transliterate
 
     # Kanji to Latin transcription instance via pykakasi
     self.kakasi = pykakasi.kakasi()
+    self.kakasi_convert = self.kakasi.convert
+
+    # country specific transcription functions, generic_transcript is used
+    # for all other countries
+    self.dispatch = {
+      'jp': self.japanese_transcript,
+      'th': thai_transcript,
+      'mo': cantonese_transcript,
+      'hk': cantonese_transcript
+    }
+
+    # Names of common features repeat a lot, thus cache transcriptions
+    # by country and name
+    self.memcache = LRUCache(200000)
+
+    if cachefile is None:
+      self.diskcache = None
+    else:
+      self.diskcache = TranscriptCache(cachefile, versions)
 
   def transcript(self, id, country, unistr):
     if (country == ""):
       vout("doing transcription for >>%s<< (generic, osm_id %s)\n" % (unistr,id))
     else:
       vout("doing transcription for >>%s<< (country %s, osm_id %s)\n" % (unistr,country,id))
-    if country == 'jp':
-      # this should mimic the old api behavior (I hate API changes)
-      # new API does not have all options anymore :(
-      kanji = self.kakasi.convert(unistr)
-      out = ""
-      for w in kanji:
-        w['hepburn'] = w['hepburn'].strip()
-        if (len(w['hepburn']) > 0):
-          out = out +  w['hepburn'].capitalize() + " "
-      return(out.strip())
-
-    if country == 'th':
-      return(thai_transcript(unistr))
+    # names not needing transcription are cheaper to check than to look up
+    # and would only push expensive transcriptions out of the caches
+    if self.is_latin(country, unistr):
+      return(unistr)
+    key = (country, unistr)
+    latin = self.memcache.get(key)
+    if latin is None:
+      latin = self.persistent_transcript(country, unistr)
+      # do not store errors
+      if isinstance(latin, str):
+        self.memcache.set(key, latin)
+    return(latin)
+
+  def persistent_transcript(self, country, unistr):
+    if self.diskcache is None:
+      return(self.do_transcript(country, unistr))
+    latin = self.diskcache.get(country, unistr)
+    if latin is None:
+      latin = self.do_transcript(country, unistr)
+      # do not store errors
+      if isinstance(latin, str):
+        self.diskcache.set(country, unistr, latin)
+    return(latin)
+
+  def do_transcript(self, country, unistr):
+    fn = self.dispatch.get(country)
+    if fn is not None:
+      return(fn(unistr))
+    return(self.generic_transcript(unistr))
+
+  def japanese_transcript(self, unistr):
+    # this should mimic the old api behavior (I hate API changes)
+    # new API does not have all options anymore :(
+    words = (w['hepburn'].strip() for w in self.kakasi_convert(unistr))
+    return(' '.join(w.capitalize() for w in words if w))
+
+  # Check if the generic transcription would return the name unchanged
+  def is_latin(self, country, unistr):
+    if country in self.dispatch:
+      return False
+
+    # plain ASCII needs no transliteration and is NFC by definition
+    if unistr.isascii():
+      return True
 
-    if country in ['mo','hk']:
-      return(cantonese_transcript(unistr))
+    # neither does Latin up to Extended-B, which is NFC as combining marks start at 0x0300
+    return max(map(ord, unistr)) < 0x0250
 
-    return(unicodedata.normalize('NFC', self.icutr(unistr)))
+  def generic_transcript(self, unistr):
+    return(self.icutr(unistr))
 
 class Coord2Country:
   features = []
@@ -200,43 +373,62 @@ class Coord2Country:
       self.features.append([shapely.prepared.prep(geom), cc])
     vout(f"Found boundaries: {boundaries}")
 
-  def getCountry(self,id,lon,lat):
-    if lon == '' or lat == '':
-      return ''
+  # Coordinates repeat a lot in OSM data, thus cache lookups using the
+  # unconverted strings from the request as key.
+  @staticmethod
+  @functools.lru_cache(maxsize=100000)
+  def lookup(lon,lat):
     p = shapely.geometry.Point(float(lon), float(lat))
-    for f in self.features:
+    for f in Coord2Country.features:
       if f[0].contains(p):
-        country = f[1]
-        vout("country for %s/%s is %s (osm_id %s)\n" % (lon,lat,country,id))
         return f[1]
-    vout("country for %s/%s is unknown (osm_id %s)\n" % (lon,lat,id))
     return ''
 
+  def getCountry(self,id,lon,lat):
+    if lon == '' or lat == '':
+      return ''
+    country = self.lookup(lon,lat)
+    if country != '':
+      vout("country for %s/%s is %s (osm_id %s)\n" % (lon,lat,country,id))
+    else:
+      vout("country for %s/%s is unknown (osm_id %s)\n" % (lon,lat,id))
+    return country
+
 co2c = Coord2Country(args.geomdir)
-tc = transcriptor()
+libversions = 'pykakasi '+version('pykakasi')+', '+'tltk '+version('tltk')+', '+'pinyin_jyutping_sentence '+version('pinyin_jyutping_sentence')
+tc = transcriptor(args.cachefile, f'osml10n {vers}, {libversions}, ICU {icu.ICU_VERSION}')
 
 # Read a request from the socket. First read 4 bytes containing the length
-# of the request data, then read the data itself and return as a UTF-8 string.
+# of the request data, then read the data itself and return it undecoded.
 # Return 'None' if the connection was closed.
 async def read_request(reader):
   try:
-    lendata = await reader.readexactly(4)
-    if len(lendata) == 0:
-      return
-    length = struct.unpack('I', lendata)
-    if length == 0:
-      return
-    data = await reader.readexactly(length[0])
-    return data.decode('utf-8')
+    # length is an unsigned 32 bit integer in native byte order
+    length = int.from_bytes(await reader.readexactly(4), sys.byteorder)
+    return await reader.readexactly(length)
   except asyncio.exceptions.IncompleteReadError:
     return
 
+# Split 'count' slash separated ASCII fields starting at offset 'start' from
+# raw request data. The remainder is the name which is returned as the last
+# element decoded from UTF-8. Only the name needs to be decoded as UTF-8.
+def split_request(data, start, count):
+  fields = []
+  for _ in range(count):
+    end = data.find(b'/', start)
+    if end < 0:
+      raise ValueError(f"expected {count+1} fields in request")
+    fields.append(data[start:end].decode('ascii'))
+    start = end + 1
+  fields.append(data[start:].decode('utf-8'))
+  return fields
+
 # Write the reply data to the socket and flush. First writes 4 bytes containing
 # the length of the data and then the data itself.
 async def send_reply(writer, reply):
   data = reply.encode('utf-8')
   length = len(data)
-  writer.write(struct.pack('I', length) + data)
+  writer.write(length.to_bytes(4, sys.byteorder) + data)
   await writer.drain()
 
 async def handle_connection(reader, writer):
@@ -247,26 +439,28 @@ async def handle_connection(reader, writer):
         data = await read_request(reader)
         if data is None:
           vout('Connection closed\n')
+          vout(f'Country lookup cache: {Coord2Country.lookup.cache_info()}\n')
+          vout(f'Transcription cache: {tc.memcache.cache_info()}\n')
           return
 
         # We support the following formats:
         # CC/id/cc/string
         # XY/id/lon/lat/string
         cmd = data[0:2]
-        if cmd == 'CC':
-          (id,cc,name) = data[3:].split('/', 2)
-        elif cmd == 'XY':
-          (id,lon,lat,name) = data[3:].split('/', 3)
+        if cmd == b'CC':
+          (id,cc,name) = split_request(data, 3, 2)
+        elif cmd == b'XY':
+          (id,lon,lat,name) = split_request(data, 3, 3)
           # Do check for country only if string contains Thai or CJK characters
-          if contains_cjk(name):
+          script = detect_script(name)
+          if script == 'cjk':
             cc = co2c.getCountry(id,lon,lat)
+          elif script == 'th':
+            cc = 'th'
           else:
-            if contains_thai(name):
-              cc = 'th'
-            else:
-              cc = ''
+            cc = ''
         else:
-          sys.stderr.write(f"Ignore unkown command '{cmd}'\n")
+          sys.stderr.write(f"Ignore unkown command '{cmd.decode('utf-8', 'replace')}'\n")
           await send_reply(writer, '')
           continue
 
@@ -284,21 +478,104 @@ async def handle_connection(reader, writer):
         sys.stderr.write(f"Error in id '{id}': {err}, {type(err)}\n")
         await send_reply(writer, '')
 
+# Create a listening UNIX domain socket. This is done before forking
+# workers, as a socket path can not be bound more than once.
+def unix_listen(path):
+  # remove stale socket from a previous run
+  with contextlib.suppress(FileNotFoundError):
+    if stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # permissions of the socket are determined by the umask
+  sock.bind(path)
+  return sock
+
+unix_sock = None
+
 async def main():
-  server = await asyncio.start_server(handle_connection, host=args.bindaddr, port=args.port, reuse_address=True, reuse_port=True)
+  if unix_sock is not None:
+    server = await asyncio.start_unix_server(handle_connection, sock=unix_sock)
+  else:
+    server = await asyncio.start_server(handle_connection, host=args.bindaddr, port=args.port, reuse_address=True, reuse_port=True)
   addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
   vout(f'Serving on {addrs}\n')
 
   async with server:
     await server.serve_forever()
 
-if __name__ == "__main__":
-  sys.stdout.write("ready.\n(using pykakasi "+version('pykakasi')+', '+"tltk "+version('tltk')+', '+"pinyin_jyutping_sentence "+version('pinyin_jyutping_sentence')+')\n')
-  if args.sdnotify:
-    import sdnotify
-    sdnotify.SystemdNotifier().notify("READY=1")
+# signals terminating the parent process of the workers
+stop_signals = (signal.SIGTERM, signal.SIGHUP)
+
+# Terminate all worker processes and wait for them to exit
+def stop_workers(children):
+  for pid in children:
+    with contextlib.suppress(ProcessLookupError):
+      os.kill(pid, signal.SIGTERM)
+  for pid in children:
+    with contextlib.suppress(ChildProcessError):
+      os.waitpid(pid, 0)
+
+def stop_on_signal(signum, frame):
+  vout(f'Got signal {signum}, stopping workers\n')
+  stop_workers(children)
+  sys.exit(0)
+
+# Run the server in a worker process. All workers bind to the same address
+# using SO_REUSEPORT, thus the kernel distributes connections between them.
+# In case of a UNIX domain socket they accept from the same socket.
+def run_worker():
+  signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+  status = 0
   try:
     asyncio.run(main())
   except KeyboardInterrupt:
-    print('Stopping server\n')
+    pass
+  except Exception as err:
+    sys.stderr.write(f"Worker {os.getpid()} failed: {err}\n")
+    status = 1
+  os._exit(status)
 
+if __name__ == "__main__":
+  sys.stdout.write("ready.\n(using "+libversions+')\n')
+  sys.stdout.flush()
+  workers = args.workers
+  if workers == 0:
+    workers = os.cpu_count() or 1
+  # bind address starting with a slash is a path of a UNIX domain socket
+  if args.bindaddr.startswith('/'):
+    unix_sock = unix_listen(args.bindaddr)
+  # fork workers after loading, so data and modules are shared copy-on-write
+  children = []
+  if workers > 1:
+    # block termination signals until the handler forwarding them to the
+    # workers is installed, workers get default handling restored
+    signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+    for _ in range(workers):
+      pid = os.fork()
+      if pid == 0:
+        run_worker()
+      children.append(pid)
+    vout(f'Started {workers} worker processes\n')
+  if args.sdnotify:
+    import sdnotify
+    sdnotify.SystemdNotifier().notify("READY=1")
+  if children:
+    # forward termination requests to the workers, so none of them keeps
+    # serving on the port if only the parent gets killed
+    for signum in stop_signals:
+      signal.signal(signum, stop_on_signal)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, stop_signals)
+    try:
+      # terminate all workers if one of them exits to get restarted by systemd
+      os.wait()
+    except KeyboardInterrupt:
+      print('Stopping server\n')
+      stop_workers(children)
+      sys.exit(0)
+    stop_workers(children)
+    sys.exit(1)
+  else:
+    try:
+      asyncio.run(main())
+    except KeyboardInterrupt:
+      print('Stopping server\n')